@@ -1,16 +1,24 @@
 import os
 import io
 import base64
+import hmac
 import sqlite3
 import json
 import re
+import secrets
 import tempfile
+import time
+from contextlib import closing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from hashlib import pbkdf2_hmac
 from typing import Dict, List, Tuple
 
+import numpy as np
+import pandas as pd
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageOps
 from streamlit_drawable_canvas import st_canvas
 
 from reportlab.lib.pagesizes import A4
@@ -28,6 +36,9 @@ from reportlab.graphics.charts.barcharts import VerticalBarChart
 from reportlab.graphics.charts.legends import Legend
 
 import gspread
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from gspread.utils import absolute_range_name, rowcol_to_a1
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
@@ -47,6 +58,23 @@ ADMIN_PASSWORD = st.secrets.get("ADMIN_PASSWORD", "1234")
 
 STATUS_OPCIONES = ["OPERATIVO", "OPERATIVO CON FALLA", "INOPERATIVO"]
 
+# usuario: sin espacios, como indica el formulario (compilado una vez, no en cada submit)
+USERNAME_RE = re.compile(r"\S+")
+# prefijo de archivo de foto: cualquier otro carácter (espacios, "/", acentos) pasa a "_"
+FILE_PREFIX_INVALID_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+# id de archivo de Drive: directo, en /d/<id>/ o en ?id=<id>
+DRIVE_ID_RE = re.compile(r"[A-Za-z0-9_-]{10,}")
+DRIVE_ID_IN_URL_RES = (re.compile(r"/d/([A-Za-z0-9_-]+)"), re.compile(r"[?&]id=([A-Za-z0-9_-]+)"))
+
+# mínimo de píxeles con trazo para considerar que el canvas tiene una firma
+FIRMA_MIN_PIXELES = 50
+# gris por debajo de este valor se guarda como trazo (negro) en el PNG de 1 bit
+FIRMA_UMBRAL_BN = 200
+
+# fotos de evidencia: lado mayor y calidad JPEG con que se guardan/suben
+FOTO_MAX_LADO = 1280
+FOTO_JPEG_QUALITY = 75
+
 # ---------------------------
 # GOOGLE (ENV VARS EN RENDER)
 # ---------------------------
@@ -57,6 +85,32 @@ STATUS_OPCIONES = ["OPERATIVO", "OPERATIVO CON FALLA", "INOPERATIVO"]
 # DRIVE_PHOTOS_ID        -> folder id para fotos
 # DRIVE_SIGNATURES_ID    -> folder id para firmas
 
+DRIVE_RESUMABLE_MIN_BYTES = 5 * 1024 * 1024
+# reintentos (backoff exponencial de googleapiclient) ante 429/5xx de Drive
+GOOGLE_NUM_RETRIES = 5
+# Sheets: mismos reintentos que Drive, con espera exponencial acotada (segundos)
+SHEETS_MAX_ESPERA_S = 16
+
+
+class RetryHTTPClient(HTTPClient):
+    """
+    HTTPClient de gspread con reintentos acotados: solo 429/5xx, hasta GOOGLE_NUM_RETRIES
+    reintentos, respetando Retry-After y con espera exponencial tope SHEETS_MAX_ESPERA_S.
+    Pasado el último intento se propaga el APIError.
+    """
+
+    def request(self, *args, **kwargs):
+        for intento in range(GOOGLE_NUM_RETRIES + 1):
+            try:
+                return super().request(*args, **kwargs)
+            except APIError as e:
+                status = e.response.status_code
+                if intento == GOOGLE_NUM_RETRIES or (status != 429 and status < 500):
+                    raise
+                retry_after = e.response.headers.get("Retry-After", "")
+                espera = float(retry_after) if retry_after.isdigit() else 2 ** intento
+                time.sleep(min(espera, SHEETS_MAX_ESPERA_S))
+
 
 @st.cache_resource
 def get_google_clients():
@@ -71,7 +125,8 @@ def get_google_clients():
         "https://www.googleapis.com/auth/spreadsheets",
     ]
     creds = Credentials.from_service_account_info(info, scopes=scopes)
-    gc = gspread.authorize(creds)
+    # RetryHTTPClient: reintenta (acotado) los 429/5xx de Sheets (cuota por minuto)
+    gc = gspread.authorize(creds, http_client=RetryHTTPClient)
     drive = build("drive", "v3", credentials=creds)
     return gc, drive, sheet_id
 
@@ -79,17 +134,24 @@ def get_google_clients():
 def extract_drive_file_id(url_or_id: str) -> str:
     if not url_or_id:
         return ""
-    if re.fullmatch(r"[A-Za-z0-9_-]{10,}", url_or_id):
+    if DRIVE_ID_RE.fullmatch(url_or_id):
         return url_or_id
-    m = re.search(r"/d/([A-Za-z0-9_-]+)", url_or_id)
-    if m:
-        return m.group(1)
-    m = re.search(r"[?&]id=([A-Za-z0-9_-]+)", url_or_id)
-    if m:
-        return m.group(1)
+    for pattern in DRIVE_ID_IN_URL_RES:
+        m = pattern.search(url_or_id)
+        if m:
+            return m.group(1)
     return ""
 
 
+@st.cache_resource
+def _drive_local_copies() -> Dict[str, str]:
+    """
+    file_id de Drive -> archivo local que este proceso ya tiene (lo subió él mismo).
+    Evita volver a descargar firmas/fotos recién subidas al generar el PDF.
+    """
+    return {}
+
+
 def upload_file_to_drive(local_path: str, folder_id: str) -> str:
     if not local_path or not os.path.exists(local_path) or not folder_id:
         return ""
@@ -98,15 +160,19 @@ def upload_file_to_drive(local_path: str, folder_id: str) -> str:
         return ""
 
     metadata = {"name": os.path.basename(local_path), "parents": [folder_id]}
-    media = MediaFileUpload(local_path, resumable=True)
+    # firmas/fotos/PDFs chicos: un solo POST multipart; la sesión resumable solo compensa en archivos grandes
+    resumable = os.path.getsize(local_path) > DRIVE_RESUMABLE_MIN_BYTES
+    media = MediaFileUpload(local_path, resumable=resumable)
 
     created = drive.files().create(
         body=metadata,
         media_body=media,
         fields="id",
-    ).execute()
+    ).execute(num_retries=GOOGLE_NUM_RETRIES)
 
     fid = created.get("id", "")
+    if fid:
+        _drive_local_copies()[fid] = local_path
     return f"https://drive.google.com/file/d/{fid}/view" if fid else ""
 
 
@@ -114,6 +180,9 @@ def download_drive_file(file_id_or_url: str, suffix: str = "") -> str:
     file_id = extract_drive_file_id(file_id_or_url)
     if not file_id:
         return ""
+    local_copy = _drive_local_copies().get(file_id, "")
+    if local_copy and os.path.exists(local_copy):
+        return local_copy
     _, drive, _ = get_google_clients()
     if not drive:
         return ""
@@ -126,18 +195,73 @@ def download_drive_file(file_id_or_url: str, suffix: str = "") -> str:
         downloader = MediaIoBaseDownload(f, request)
         done = False
         while not done:
-            _, done = downloader.next_chunk()
+            _, done = downloader.next_chunk(num_retries=GOOGLE_NUM_RETRIES)
 
     return out_path
 
 
-def append_row_sheet(sheet_name: str, row: list):
+@st.cache_resource
+def get_worksheets() -> Dict[str, gspread.Worksheet]:
+    """
+    Abre el spreadsheet y lista sus hojas una sola vez por proceso
+    (open_by_key + worksheets() en vez de open_by_key + worksheet(name) por cada escritura).
+    """
     gc, _, sheet_id = get_google_clients()
     if not gc:
-        return
+        return {}
     sh = gc.open_by_key(sheet_id)
-    ws = sh.worksheet(sheet_name)
-    ws.append_row(row, value_input_option="USER_ENTERED")
+    return {ws.title: ws for ws in sh.worksheets()}
+
+
+def _sheet_cell(value) -> dict:
+    # valores tipados y literales (como RAW): números/booleanos como tales, el resto como texto.
+    # Un texto del operador que empiece con "=" o "+" no se interpreta como fórmula.
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": "" if value is None else str(value)}}
+
+
+def append_rows_multi_sheet(rows_by_sheet: Dict[str, list]):
+    """
+    Agrega filas a varias hojas en un solo spreadsheets.batchUpdate (appendCells por hoja),
+    en lugar de un append por hoja.
+    rows_by_sheet = {"reports": [[...]], "report_items": [[...], [...]]}
+    """
+    wss = get_worksheets()
+    requests = [
+        {
+            "appendCells": {
+                "sheetId": wss[name].id,
+                "rows": [{"values": [_sheet_cell(v) for v in row]} for row in rows],
+                "fields": "userEnteredValue",
+            }
+        }
+        for name, rows in rows_by_sheet.items()
+        if rows and name in wss
+    ]
+    if not requests:
+        return
+    next(iter(wss.values())).spreadsheet.batch_update({"requests": requests})
+
+
+def _sheet_key_index(sheet_name: str) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Headers (fila 1) + índice clave (columna A) -> número de fila, leídos en un solo values.batchGet.
+    Sin caché: la hoja se puede ordenar/filtrar/editar a mano, así que el número de fila se lee al momento.
+    """
+    ws = get_worksheets().get(sheet_name)
+    if not ws:
+        return [], {}
+    resp = ws.spreadsheet.values_batch_get([
+        absolute_range_name(ws.title, "1:1"),
+        absolute_range_name(ws.title, "A:A"),
+    ])
+    header_rows, key_rows = (vr.get("values", []) for vr in resp.get("valueRanges", [{}, {}]))
+    headers = header_rows[0] if header_rows else []
+    index = {r[0].strip(): i + 1 for i, r in enumerate(key_rows) if r and r[0].strip()}
+    return headers, index
 
 
 def update_report_row_in_sheet(report_id: int, updates: dict):
@@ -145,26 +269,39 @@ def update_report_row_in_sheet(report_id: int, updates: dict):
     Busca report_id en la hoja 'reports' (columna A) y actualiza columnas por header.
     updates = {"supervisor_user": "...", "pdf_path": "...", ...}
     """
-    gc, _, sheet_id = get_google_clients()
-    if not gc:
+    ws = get_worksheets().get("reports")
+    if not ws:
         return
 
-    sh = gc.open_by_key(sheet_id)
-    ws = sh.worksheet("reports")
-
-    headers = ws.row_values(1)
-    if not headers:
+    report_key = str(report_id)
+    headers, index = _sheet_key_index("reports")
+    row_idx = index.get(report_key)
+    if not headers or not row_idx:
         return
 
-    cell = ws.find(str(report_id))
-    if not cell:
-        return
+    payload = [
+        {"range": rowcol_to_a1(row_idx, headers.index(key) + 1), "values": [[val]]}
+        for key, val in updates.items() if key in headers
+    ]
+    if payload:
+        ws.batch_update(payload, value_input_option="RAW")
+
+
+@st.cache_resource
+def _sync_executor() -> ThreadPoolExecutor:
+    # un solo worker por proceso: las subidas a Drive/Sheets quedan en serie
+    return ThreadPoolExecutor(max_workers=1)
+
 
-    row_idx = cell.row
-    for key, val in updates.items():
-        if key in headers:
-            col_idx = headers.index(key) + 1
-            ws.update_cell(row_idx, col_idx, val)
+def _sync_approved_report(report_id: int, pdf_path: str, updates: dict) -> str:
+    """
+    Sube el PDF final a Drive y marca la aprobación en la hoja 'reports'.
+    Corre en segundo plano (sin llamadas st.*); retorna la URL del PDF en Drive.
+    """
+    pdf_folder_id = os.environ.get("DRIVE_PDFS_ID", "").strip()
+    pdf_drive_url = upload_file_to_drive(pdf_path, pdf_folder_id)
+    update_report_row_in_sheet(report_id, {**updates, "pdf_path": pdf_drive_url})
+    return pdf_drive_url
 
 
 # ---------------------------
@@ -251,6 +388,9 @@ CHECKLISTS: Dict[str, List[Tuple[str, List[str]]]] = {
     ]
 }
 
+# índice nombre -> equipo (se arma una sola vez, no en cada rerun del operador)
+EQUIPOS_POR_NOMBRE: Dict[str, dict] = {e["nombre"]: e for e in EQUIPOS}
+
 
 # ---------------------------
 # DB
@@ -264,124 +404,140 @@ def ensure_dirs():
 
 
 def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # una conexión por llamada (se cierra con closing()): cada sesión de Streamlit corre en su propio
+    # hilo y una conexión compartida mezclaría sus transacciones
+    conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
 
 def hash_password(password: str, salt: bytes) -> str:
     dk = pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120000)
-    return base64.b64encode(dk).decode("utf-8")
+    return base64.b64encode(dk).decode("ascii")
 
 
+@st.cache_resource
 def init_db():
+    # una vez por proceso: dirs, tablas, índices y seed del admin no cambian entre reruns
     ensure_dirs()
-    conn = db()
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            full_name TEXT NOT NULL,
-            role TEXT NOT NULL CHECK(role IN ('operador','supervisor')),
-            active INTEGER NOT NULL DEFAULT 1,
-            salt TEXT NOT NULL,
-            pw_hash TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            created_at TEXT NOT NULL,
-            created_date TEXT NOT NULL,
-            equipment_tipo TEXT NOT NULL,
-            equipment_codigo TEXT NOT NULL,
-            equipment_nombre TEXT NOT NULL,
-            horometro INTEGER NOT NULL,
-            operador_user TEXT NOT NULL,
-            operador_nombre TEXT NOT NULL,
-            obs_general TEXT,
-            resultado_final TEXT NOT NULL,
-            estado_general TEXT NOT NULL,
-            firma_operador_path TEXT,
-            supervisor_user TEXT,
-            supervisor_nombre TEXT,
-            firma_supervisor_path TEXT,
-            aprobado INTEGER NOT NULL DEFAULT 0
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS report_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            report_id INTEGER NOT NULL,
-            seccion TEXT NOT NULL,
-            item TEXT NOT NULL,
-            estado TEXT NOT NULL,
-            observacion TEXT,
-            foto_path TEXT,
-            FOREIGN KEY(report_id) REFERENCES reports(id)
-        )
-    """)
+    with closing(db()) as conn:
+        c = conn.cursor()
 
-    conn.commit()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                full_name TEXT NOT NULL,
+                role TEXT NOT NULL CHECK(role IN ('operador','supervisor')),
+                active INTEGER NOT NULL DEFAULT 1,
+                salt TEXT NOT NULL,
+                pw_hash TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
 
-    c.execute("SELECT 1 FROM users WHERE username=?", (ADMIN_USER,))
-    if not c.fetchone():
-        salt = os.urandom(16)
-        salt_b64 = base64.b64encode(salt).decode("utf-8")
-        pw_hash = hash_password(ADMIN_PASSWORD, salt)
         c.execute("""
-            INSERT INTO users (username, full_name, role, active, salt, pw_hash, created_at)
-            VALUES (?,?,?,?,?,?,?)
-        """, (
-            ADMIN_USER, "Supervisor", "supervisor", 1, salt_b64, pw_hash,
-            datetime.now().isoformat(timespec="seconds")
-        ))
+            CREATE TABLE IF NOT EXISTS reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                created_date TEXT NOT NULL,
+                equipment_tipo TEXT NOT NULL,
+                equipment_codigo TEXT NOT NULL,
+                equipment_nombre TEXT NOT NULL,
+                horometro INTEGER NOT NULL,
+                operador_user TEXT NOT NULL,
+                operador_nombre TEXT NOT NULL,
+                obs_general TEXT,
+                resultado_final TEXT NOT NULL,
+                estado_general TEXT NOT NULL,
+                firma_operador_path TEXT,
+                supervisor_user TEXT,
+                supervisor_nombre TEXT,
+                firma_supervisor_path TEXT,
+                aprobado INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS report_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                report_id INTEGER NOT NULL,
+                seccion TEXT NOT NULL,
+                item TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                observacion TEXT,
+                foto_path TEXT,
+                FOREIGN KEY(report_id) REFERENCES reports(id)
+            )
+        """)
+
+        # detalle de un informe: evita recorrer toda la tabla de ítems por report_id
+        c.execute("CREATE INDEX IF NOT EXISTS idx_report_items_report_id ON report_items(report_id, id)")
+        # pendientes (aprobado=0 ordenado por fecha) y filtros por rango de fecha
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reports_aprobado_created_at ON reports(aprobado, created_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reports_created_date ON reports(created_date)")
+
         conn.commit()
 
+        c.execute("SELECT 1 FROM users WHERE username=?", (ADMIN_USER,))
+        if not c.fetchone():
+            salt = os.urandom(16)
+            salt_b64 = base64.b64encode(salt).decode("ascii")
+            pw_hash = hash_password(ADMIN_PASSWORD, salt)
+            c.execute("""
+                INSERT INTO users (username, full_name, role, active, salt, pw_hash, created_at)
+                VALUES (?,?,?,?,?,?,?)
+            """, (
+                ADMIN_USER, "Supervisor", "supervisor", 1, salt_b64, pw_hash,
+                datetime.now().isoformat(timespec="seconds")
+            ))
+            conn.commit()
+
 
 # ---------------------------
 # AUTH
 # ---------------------------
 def auth_user(username: str, password: str):
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username=? AND active=1", (username.strip(),))
-    row = c.fetchone()
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT username, full_name, role, salt, pw_hash
+            FROM users
+            WHERE username=? AND active=1
+        """, (username.strip(),))
+        row = c.fetchone()
     if not row:
         return None
     salt = base64.b64decode(row["salt"])
     pw_hash = hash_password(password, salt)
-    if pw_hash != row["pw_hash"]:
+    if not hmac.compare_digest(pw_hash, row["pw_hash"]):
         return None
-    return dict(row)
+    return {"username": row["username"], "full_name": row["full_name"], "role": row["role"]}
 
 
 def create_user(username: str, full_name: str, password: str, role: str, active: bool):
-    conn = db()
-    c = conn.cursor()
     salt = os.urandom(16)
-    salt_b64 = base64.b64encode(salt).decode("utf-8")
+    salt_b64 = base64.b64encode(salt).decode("ascii")
     pw_hash = hash_password(password, salt)
-    c.execute("""
-        INSERT INTO users (username, full_name, role, active, salt, pw_hash, created_at)
-        VALUES (?,?,?,?,?,?,?)
-    """, (
-        username.strip(), full_name.strip(), role, 1 if active else 0,
-        salt_b64, pw_hash, datetime.now().isoformat(timespec="seconds")
-    ))
-    conn.commit()
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO users (username, full_name, role, active, salt, pw_hash, created_at)
+            VALUES (?,?,?,?,?,?,?)
+        """, (
+            username.strip(), full_name.strip(), role, 1 if active else 0,
+            salt_b64, pw_hash, datetime.now().isoformat(timespec="seconds")
+        ))
+        conn.commit()
+    fetch_users.clear()
 
 
+@st.cache_data(ttl=30, show_spinner=False)
 def fetch_users():
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT id, username, full_name, role, active, created_at FROM users ORDER BY created_at DESC")
-    return [dict(r) for r in c.fetchall()]
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, full_name, role, active, created_at FROM users ORDER BY created_at DESC")
+        return [dict(r) for r in c.fetchall()]
 
 
 # ---------------------------
@@ -395,37 +551,73 @@ def compute_result(items_estado: List[str]) -> Tuple[str, str]:
     return ("OPERATIVO", "APTO")
 
 
+def make_file_name(prefix: str, ext: str) -> str:
+    # timestamp + sufijo aleatorio: no colisiona aunque dos sesiones guarden en el mismo instante
+    return f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}{ext}"
+
+
 def save_uploaded_image(uploaded_file, folder: str, prefix: str) -> str:
     """
     Guarda local (por compatibilidad) y sube a Drive.
+    La foto se endereza según EXIF, se reduce a FOTO_MAX_LADO px y se guarda como JPEG antes de subirla.
     Retorna URL de Drive (preferido). Si no hay Google config, retorna path local.
     """
     if not uploaded_file:
         return ""
-    ext = os.path.splitext(uploaded_file.name)[1].lower()
-    if ext not in [".png", ".jpg", ".jpeg", ".webp"]:
-        ext = ".png"
-    filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}"
-    local_path = os.path.join("data", folder, filename)
-    with open(local_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    try:
+        # el JPEG re-codificado no conserva el EXIF: se aplica la rotación del celular antes
+        img = ImageOps.exif_transpose(Image.open(uploaded_file))
+    except OSError:
+        # si PIL no la puede leer, se guarda tal cual
+        ext = os.path.splitext(uploaded_file.name)[1].lower()
+        if ext not in [".png", ".jpg", ".jpeg", ".webp"]:
+            ext = ".png"
+        local_path = os.path.join("data", folder, make_file_name(prefix, ext))
+        with open(local_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
+    else:
+        img.thumbnail((FOTO_MAX_LADO, FOTO_MAX_LADO), Image.LANCZOS)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # JPEG no tiene alfa: lo transparente va sobre blanco (como la firma), no en negro
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        local_path = os.path.join("data", folder, make_file_name(prefix, ".jpg"))
+        img.convert("RGB").save(local_path, format="JPEG", quality=FOTO_JPEG_QUALITY, optimize=True)
 
     folder_id = os.environ.get("DRIVE_PHOTOS_ID", "").strip()
     drive_url = upload_file_to_drive(local_path, folder_id)
     return drive_url or local_path
 
 
+def _signature_has_ink(image_data, thresh: int = 250, min_px: int = FIRMA_MIN_PIXELES) -> bool:
+    """
+    Cuenta píxeles no blancos (y no transparentes) directo sobre el array RGBA del canvas,
+    sin armar una imagen PIL. Un canvas vacío devuelve False.
+    """
+    arr = np.asarray(image_data)
+    ink = (arr[..., 3] > 0) & (arr[..., :3].min(axis=2) < thresh)
+    return int(np.count_nonzero(ink)) >= min_px
+
+
 def save_signature_from_canvas(canvas_result, folder: str, prefix: str) -> str:
     """
     Guarda local (por compatibilidad) y sube a Drive.
     Retorna URL de Drive (preferido). Si no hay Google config, retorna path local.
+    Retorna "" si el canvas está vacío.
     """
     if canvas_result is None or canvas_result.image_data is None:
         return ""
-    img = Image.fromarray(canvas_result.image_data.astype("uint8")).convert("RGBA")
-    filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.png"
+    if not _signature_has_ink(canvas_result.image_data):
+        return ""
+    rgba = Image.fromarray(canvas_result.image_data.astype(np.uint8, copy=False), mode="RGBA")
+    # firma sobre blanco y a 1 bit: el PNG queda ~10x más chico y optimize=True sale barato
+    img = Image.new("L", rgba.size, 255)
+    img.paste(rgba.convert("L"), mask=rgba.getchannel("A"))
+    img = img.point(lambda p: 255 if p >= FIRMA_UMBRAL_BN else 0, mode="1")
+    filename = make_file_name(prefix, ".png")
     local_path = os.path.join("data", folder, filename)
-    img.save(local_path)
+    img.save(local_path, format="PNG", optimize=True)
 
     folder_id = os.environ.get("DRIVE_SIGNATURES_ID", "").strip()
     drive_url = upload_file_to_drive(local_path, folder_id)
@@ -433,70 +625,98 @@ def save_signature_from_canvas(canvas_result, folder: str, prefix: str) -> str:
 
 
 def insert_report(payload: dict) -> int:
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO reports (
-            created_at, created_date, equipment_tipo, equipment_codigo, equipment_nombre, horometro,
-            operador_user, operador_nombre, obs_general,
-            resultado_final, estado_general, firma_operador_path,
-            supervisor_user, supervisor_nombre, firma_supervisor_path, aprobado
-        )
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
-        payload["created_at"], payload["created_date"], payload["equipment_tipo"], payload["equipment_codigo"], payload["equipment_nombre"],
-        payload["horometro"], payload["operador_user"], payload["operador_nombre"], payload.get("obs_general", ""),
-        payload["resultado_final"], payload["estado_general"], payload.get("firma_operador_path", ""),
-        None, None, None, 0
-    ))
-    report_id = c.lastrowid
-
-    for it in payload["items"]:
+    with closing(db()) as conn:
+        c = conn.cursor()
         c.execute("""
-            INSERT INTO report_items (report_id, seccion, item, estado, observacion, foto_path)
-            VALUES (?,?,?,?,?,?)
+            INSERT INTO reports (
+                created_at, created_date, equipment_tipo, equipment_codigo, equipment_nombre, horometro,
+                operador_user, operador_nombre, obs_general,
+                resultado_final, estado_general, firma_operador_path,
+                supervisor_user, supervisor_nombre, firma_supervisor_path, aprobado
+            )
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
         """, (
-            report_id, it["seccion"], it["item"], it["estado"],
-            it.get("observacion", ""), it.get("foto_path", "")
+            payload["created_at"], payload["created_date"], payload["equipment_tipo"], payload["equipment_codigo"], payload["equipment_nombre"],
+            payload["horometro"], payload["operador_user"], payload["operador_nombre"], payload.get("obs_general", ""),
+            payload["resultado_final"], payload["estado_general"], payload.get("firma_operador_path", ""),
+            None, None, None, 0
         ))
+        report_id = c.lastrowid
+
+        c.executemany("""
+            INSERT INTO report_items (report_id, seccion, item, estado, observacion, foto_path)
+            VALUES (?,?,?,?,?,?)
+        """, [
+            (
+                report_id, it["seccion"], it["item"], it["estado"],
+                it.get("observacion", ""), it.get("foto_path", "")
+            )
+            for it in payload["items"]
+        ])
 
-    conn.commit()
+        conn.commit()
+    invalidate_report_cache()
     return report_id
 
 
+@st.cache_data(ttl=30, show_spinner=False)
 def fetch_pending_reports():
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, created_at, equipment_codigo, equipment_nombre, operador_nombre, resultado_final, estado_general
-        FROM reports
-        WHERE aprobado=0
-        ORDER BY created_at DESC
-    """)
-    return [dict(r) for r in c.fetchall()]
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, created_at, equipment_codigo, equipment_nombre, operador_nombre, resultado_final, estado_general
+            FROM reports
+            WHERE aprobado=0
+            ORDER BY created_at DESC
+        """)
+        return [dict(r) for r in c.fetchall()]
 
 
+@st.cache_data(ttl=30, show_spinner=False)
 def fetch_report_detail(report_id: int):
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM reports WHERE id=?", (report_id,))
-    rep = c.fetchone()
-    if not rep:
-        return None, []
-    c.execute("SELECT * FROM report_items WHERE report_id=? ORDER BY id ASC", (report_id,))
-    items = [dict(r) for r in c.fetchall()]
-    return dict(rep), items
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM reports WHERE id=?", (report_id,))
+        rep = c.fetchone()
+        if not rep:
+            return None, []
+        c.execute("SELECT * FROM report_items WHERE report_id=? ORDER BY id ASC", (report_id,))
+        items = [dict(r) for r in c.fetchall()]
+        return dict(rep), items
 
 
 def approve_report(report_id: int, supervisor_user: str, supervisor_nombre: str, firma_path: str):
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        UPDATE reports
-        SET aprobado=1, supervisor_user=?, supervisor_nombre=?, firma_supervisor_path=?
-        WHERE id=?
-    """, (supervisor_user, supervisor_nombre, firma_path, report_id))
-    conn.commit()
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE reports
+            SET aprobado=1, supervisor_user=?, supervisor_nombre=?, firma_supervisor_path=?
+            WHERE id=?
+        """, (supervisor_user, supervisor_nombre, firma_path, report_id))
+        conn.commit()
+    invalidate_report_cache()
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_reports_since(start_iso: str):
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT created_date, operador_nombre, equipment_codigo, equipment_nombre, estado_general, resultado_final
+            FROM reports
+            WHERE created_date >= ?
+        """, (start_iso,))
+        return [dict(r) for r in c.fetchall()]
+
+
+def invalidate_report_cache():
+    """
+    Limpia las lecturas cacheadas de reportes luego de cualquier escritura,
+    para que pendientes / detalle / panel reflejen el cambio en el siguiente rerun.
+    """
+    fetch_pending_reports.clear()
+    fetch_report_detail.clear()
+    fetch_reports_since.clear()
 
 
 # ---------------------------
@@ -519,6 +739,27 @@ STYLE_CENTER = ParagraphStyle("c", parent=STYLE_SMALL, alignment=TA_CENTER)
 STYLE_CENTER_W = ParagraphStyle("cw", parent=STYLE_CENTER, textColor=colors.white, fontName="Helvetica-Bold")
 STYLE_SMALL_B_W = ParagraphStyle("smbw", parent=STYLE_SMALL_B, textColor=colors.white, fontName="Helvetica-Bold")
 
+# estilos de tabla compartidos: se arman una vez, no en cada PDF
+HEADER_TBL_STYLE = TableStyle([
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ("ALIGN", (0, 0), (0, 0), "LEFT"),
+    ("ALIGN", (1, 0), (1, 0), "CENTER"),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+])
+
+# informe gerencia: fotos por página (6 filas de 2)
+FOTOS_POR_PAGINA = 12
+
+PHOTO_GRID_STYLE = TableStyle([
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
+    ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
+    ("LEFTPADDING", (0, 0), (-1, -1), 6),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 6),
+    ("TOPPADDING", (0, 0), (-1, -1), 6),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+])
+
 
 def _rl_img(path: str, w_mm: float, h_mm: float):
     """
@@ -542,6 +783,42 @@ def _rl_img(path: str, w_mm: float, h_mm: float):
     return img
 
 
+@st.cache_data(show_spinner=False)
+def _asset_bytes(path: str) -> bytes:
+    """Lee una vez los assets estáticos (logo) en lugar de ir a disco en cada PDF."""
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _rl_logo(w_mm: float, h_mm: float):
+    data = _asset_bytes(LOGO_PATH)
+    if not data:
+        return None
+    img = RLImage(io.BytesIO(data), width=w_mm * mm, height=h_mm * mm)
+    img.hAlign = "LEFT"
+    return img
+
+
+def _pdf_header(title: str) -> Table:
+    logo = _rl_logo(35, 10)
+    header_tbl = Table([[logo if logo else "", Paragraph(title, STYLE_TITLE)]],
+                       colWidths=[45 * mm, 135 * mm])
+    header_tbl.setStyle(HEADER_TBL_STYLE)
+    return header_tbl
+
+
+def _photo_grid_table(cells: list) -> Table:
+    """Arma la grilla de fotos en 2 columnas; la paginación la resuelve platypus."""
+    grid = [cells[i:i + 2] for i in range(0, len(cells), 2)]
+    if grid and len(grid[-1]) == 1:
+        grid[-1].append("")
+    photo_tbl = Table(grid, colWidths=[90 * mm, 90 * mm])
+    photo_tbl.setStyle(PHOTO_GRID_STYLE)
+    return photo_tbl
+
+
 # ---------------------------
 # PDF: CHECKLIST (Supervisor)
 # ---------------------------
@@ -550,7 +827,9 @@ def generate_checklist_pdf(report_id: int) -> str:
     if not rep:
         return ""
 
-    pdf_name = f"CHECKLIST_{rep['equipment_codigo']}_{rep['created_date']}.pdf"
+    # report_id en el nombre: dos aprobaciones del mismo equipo el mismo día no se pisan el archivo
+    # (la subida a Drive corre después, en segundo plano)
+    pdf_name = f"CHECKLIST_{rep['equipment_codigo']}_{rep['created_date']}_{report_id}.pdf"
     pdf_path = os.path.join("data", "pdfs", pdf_name)
 
     doc = SimpleDocTemplate(
@@ -561,15 +840,7 @@ def generate_checklist_pdf(report_id: int) -> str:
 
     story = []
 
-    logo = _rl_img(LOGO_PATH, 35, 10)
-    header_tbl = Table([[logo if logo else "", Paragraph("CHECKLIST DE EQUIPO", STYLE_TITLE)]],
-                       colWidths=[45 * mm, 135 * mm])
-    header_tbl.setStyle(TableStyle([
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("ALIGN", (0, 0), (0, 0), "LEFT"),
-        ("ALIGN", (1, 0), (1, 0), "CENTER"),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-    ]))
+    header_tbl = _pdf_header("CHECKLIST DE EQUIPO")
     story.append(header_tbl)
 
     info = [
@@ -630,8 +901,7 @@ def generate_checklist_pdf(report_id: int) -> str:
     if fotos:
         story.append(Spacer(1, 6 * mm))
         story.append(Paragraph("Fotos adjuntas (solo ítems con evidencia)", STYLE_H2))
-        grid = []
-        row = []
+        cells = []
         for (item_name, sec, pth) in fotos:
             cell_story = []
             cell_story.append(Paragraph(f"<b>{item_name}</b><br/>{sec}", STYLE_SMALL))
@@ -639,25 +909,8 @@ def generate_checklist_pdf(report_id: int) -> str:
             if img:
                 cell_story.append(Spacer(1, 2 * mm))
                 cell_story.append(img)
-            row.append(cell_story)
-            if len(row) == 2:
-                grid.append(row)
-                row = []
-        if row:
-            row.append("")
-            grid.append(row)
-
-        photo_tbl = Table(grid, colWidths=[90 * mm, 90 * mm])
-        photo_tbl.setStyle(TableStyle([
-            ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-            ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-            ("LEFTPADDING", (0, 0), (-1, -1), 6),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-            ("TOPPADDING", (0, 0), (-1, -1), 6),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-        ]))
-        story.append(photo_tbl)
+            cells.append(cell_story)
+        story.append(_photo_grid_table(cells))
 
     story.append(PageBreak())
     story.append(Paragraph("Firmas", STYLE_H2))
@@ -760,55 +1013,50 @@ def _chart_bar(title: str, pairs: List[Tuple[str, int]], w=180 * mm, h=75 * mm,
 def generate_gerencia_pdf(start: date, end: date, supervisor_name: str) -> str:
     pdf_path = os.path.join("data", "pdfs", f"INFORME_GERENCIA_{start}_{end}.pdf")
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, created_date, operador_nombre, equipment_nombre, equipment_codigo, estado_general, resultado_final
-        FROM reports
-        WHERE created_date >= ? AND created_date <= ?
-        ORDER BY created_date DESC, id DESC
-    """, (start.isoformat(), end.isoformat()))
-    rows = [dict(r) for r in c.fetchall()]
-
-    total_informes = len(rows)
-    operadores = len(set(r["operador_nombre"] for r in rows)) if rows else 0
-    equipos_con_envio = len(set(r["equipment_codigo"] for r in rows)) if rows else 0
-    total_equipos = len(EQUIPOS)
-    equipos_sin_envio = total_equipos - equipos_con_envio
+    with closing(db()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, created_date, operador_nombre, equipment_nombre, equipment_codigo, estado_general, resultado_final
+            FROM reports
+            WHERE created_date >= ? AND created_date <= ?
+            ORDER BY created_date DESC, id DESC
+        """, (start.isoformat(), end.isoformat()))
+        rows = [dict(r) for r in c.fetchall()]
 
-    res_counts = {"APTO": 0, "RESTRICCIONES": 0, "NO APTO": 0}
+        c.execute("""
+            SELECT r.created_date, r.equipment_codigo, r.equipment_nombre, ri.seccion, ri.item, ri.foto_path
+            FROM report_items ri
+            JOIN reports r ON r.id = ri.report_id
+            WHERE r.created_date >= ? AND r.created_date <= ?
+              AND ri.foto_path IS NOT NULL AND ri.foto_path <> ''
+            ORDER BY r.created_date DESC, r.id DESC, ri.id ASC
+        """, (start.isoformat(), end.isoformat()))
+        photo_rows = [dict(r) for r in c.fetchall()]
+
+    # una sola pasada sobre los registros para todos los conteos
+    res_counter, op_counts, eq_counts, day_counts = Counter(), Counter(), Counter(), Counter()
     falla_count = 0
     for r in rows:
-        res_counts[r["resultado_final"]] = res_counts.get(r["resultado_final"], 0) + 1
+        res_counter[r["resultado_final"]] += 1
+        op_counts[r["operador_nombre"]] += 1
+        eq_counts[r["equipment_codigo"]] += 1
+        day_counts[r["created_date"]] += 1
         if r["estado_general"] in ("FALLA", "INOPERATIVO"):
             falla_count += 1
 
-    eq_counts = {}
-    for r in rows:
-        eq_counts[r["equipment_codigo"]] = eq_counts.get(r["equipment_codigo"], 0) + 1
-    top_eq = sorted(eq_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    total_informes = len(rows)
+    operadores = len(op_counts)
+    equipos_con_envio = len(eq_counts)
+    total_equipos = len(EQUIPOS)
+    equipos_sin_envio = total_equipos - equipos_con_envio
 
-    op_counts = {}
-    for r in rows:
-        op_counts[r["operador_nombre"]] = op_counts.get(r["operador_nombre"], 0) + 1
-    top_op = sorted(op_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    res_counts = {"APTO": 0, "RESTRICCIONES": 0, "NO APTO": 0}
+    res_counts.update(res_counter)
 
-    day_counts = {}
-    for r in rows:
-        dte = r["created_date"]
-        day_counts[dte] = day_counts.get(dte, 0) + 1
+    top_eq = eq_counts.most_common(10)
+    top_op = op_counts.most_common(10)
     top_days = sorted(day_counts.items(), key=lambda x: x[0])[-14:]
 
-    c.execute("""
-        SELECT r.created_date, r.equipment_codigo, r.equipment_nombre, ri.seccion, ri.item, ri.foto_path
-        FROM report_items ri
-        JOIN reports r ON r.id = ri.report_id
-        WHERE r.created_date >= ? AND r.created_date <= ?
-          AND ri.foto_path IS NOT NULL AND ri.foto_path <> ''
-        ORDER BY r.created_date DESC, r.id DESC, ri.id ASC
-    """, (start.isoformat(), end.isoformat()))
-    photo_rows = [dict(r) for r in c.fetchall()]
-
     doc = SimpleDocTemplate(
         pdf_path, pagesize=A4,
         leftMargin=15 * mm, rightMargin=15 * mm,
@@ -816,15 +1064,7 @@ def generate_gerencia_pdf(start: date, end: date, supervisor_name: str) -> str:
     )
     story = []
 
-    logo = _rl_img(LOGO_PATH, 35, 10)
-    header_tbl = Table([[logo if logo else "", Paragraph("INFORME GERENCIA - CHECKLIST EQUIPOS", STYLE_TITLE)]],
-                       colWidths=[45 * mm, 135 * mm])
-    header_tbl.setStyle(TableStyle([
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("ALIGN", (0, 0), (0, 0), "LEFT"),
-        ("ALIGN", (1, 0), (1, 0), "CENTER"),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-    ]))
+    header_tbl = _pdf_header("INFORME GERENCIA - CHECKLIST EQUIPOS")
 
     story.append(header_tbl)
     story.append(Paragraph(f"Rango: <b>{start}</b> a <b>{end}</b>  |  Supervisor: <b>{supervisor_name}</b>", STYLE_SMALL))
@@ -906,8 +1146,7 @@ def generate_gerencia_pdf(start: date, end: date, supervisor_name: str) -> str:
         story.append(Paragraph("Evidencia adjunta (útil para compras/repuestos).", STYLE_SMALL))
         story.append(Spacer(1, 4 * mm))
 
-        grid = []
-        row = []
+        cells = []
         for pr in photo_rows:
             cell_story = []
             cell_story.append(Paragraph(
@@ -922,45 +1161,16 @@ def generate_gerencia_pdf(start: date, end: date, supervisor_name: str) -> str:
                 cell_story.append(img)
             else:
                 cell_story.append(Paragraph("Foto no disponible", STYLE_SMALL))
-            row.append(cell_story)
-
-            if len(row) == 2:
-                grid.append(row)
-                row = []
-
-            if len(grid) == 6:
-                photo_tbl = Table(grid, colWidths=[90 * mm, 90 * mm])
-                photo_tbl.setStyle(TableStyle([
-                    ("VALIGN", (0, 0), (-1, -1), "TOP"),
-                    ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-                    ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-                    ("LEFTPADDING", (0, 0), (-1, -1), 6),
-                    ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-                    ("TOPPADDING", (0, 0), (-1, -1), 6),
-                    ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-                ]))
-                story.append(photo_tbl)
+            cells.append(cell_story)
+
+        # 6 filas (12 fotos) por página; cada página de continuación repite encabezado y título
+        for i in range(0, len(cells), FOTOS_POR_PAGINA):
+            if i:
                 story.append(PageBreak())
                 story.append(header_tbl)
                 story.append(Paragraph("Fotos de fallas (continuación)", STYLE_H2))
                 story.append(Spacer(1, 4 * mm))
-                grid = []
-
-        if row:
-            row.append("")
-            grid.append(row)
-        if grid:
-            photo_tbl = Table(grid, colWidths=[90 * mm, 90 * mm])
-            photo_tbl.setStyle(TableStyle([
-                ("VALIGN", (0, 0), (-1, -1), "TOP"),
-                ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-                ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-                ("LEFTPADDING", (0, 0), (-1, -1), 6),
-                ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-                ("TOPPADDING", (0, 0), (-1, -1), 6),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-            ]))
-            story.append(photo_tbl)
+            story.append(_photo_grid_table(cells[i:i + FOTOS_POR_PAGINA]))
 
     doc.build(story)
     return pdf_path
@@ -969,6 +1179,49 @@ def generate_gerencia_pdf(start: date, end: date, supervisor_name: str) -> str:
 # ---------------------------
 # UI
 # ---------------------------
+def _signature_canvas(key: str):
+    return st_canvas(
+        fill_color="rgba(255,255,255,0)",
+        stroke_width=2,
+        stroke_color="#000000",
+        background_color="#FFFFFF",
+        height=120,
+        width=520,
+        drawing_mode="freedraw",
+        key=key
+    )
+
+
+def _render_pdf_sync_jobs():
+    """Estado de la subida a Drive/Sheets (en segundo plano) de cada informe recién aprobado."""
+    for job_id, (fut, _, _) in st.session_state.get("pdf_sync_jobs", {}).items():
+        if not fut.done():
+            st.caption(f"⏳ Informe #{job_id}: subiendo PDF a Drive / Sheets...")
+        elif fut.exception():
+            st.warning(f"Informe #{job_id}: no se pudo sincronizar con Drive/Sheets ({fut.exception()}).")
+        elif fut.result():
+            st.markdown(f"📄 **PDF en Drive (informe #{job_id}):** {fut.result()}")
+
+
+@st.fragment(run_every=2)
+def _pdf_sync_status():
+    """
+    Se refresca solo (fragment) mientras haya subidas en curso, sin rerun completo de la página.
+    Cuando terminan todas, un único rerun de la app las muestra sin el auto-refresh.
+    """
+    _render_pdf_sync_jobs()
+    if all(fut.done() for fut, _, _ in st.session_state.get("pdf_sync_jobs", {}).values()):
+        st.rerun(scope="app")
+
+
+def _rango_start(rango: str, today: date) -> date:
+    if rango == "Diario":
+        return today
+    if rango == "Semanal":
+        return today - timedelta(days=7)
+    return today - timedelta(days=30)
+
+
 def sidebar_user():
     name = st.session_state.get("full_name")
     role = st.session_state.get("role")
@@ -1002,6 +1255,20 @@ def login_ui():
         st.rerun()
 
 
+# plantilla HTML de cada barra del panel (constante de módulo, no se rearma en cada rerun)
+BAR_ROW_HTML = """
+<div style="border:1px solid #e5e7eb;border-radius:10px;padding:10px;margin-bottom:10px;">
+  <div style="display:flex;justify-content:space-between;font-size:12px;color:#111;">
+    <div style="max-width:75%;white-space:nowrap;overflow:hidden;text-overflow:ellipsis;">{label}</div>
+    <div style="font-weight:700;">{value}</div>
+  </div>
+  <div style="background:#f3f4f6;border-radius:10px;height:10px;margin-top:8px;overflow:hidden;">
+    <div style="width:{pct}%;height:10px;background:#1f77b4;"></div>
+  </div>
+</div>
+"""
+
+
 def _bar_list(title: str, pairs: List[Tuple[str, int]], max_items=10):
     pairs = pairs[:max_items]
     if not pairs:
@@ -1011,20 +1278,12 @@ def _bar_list(title: str, pairs: List[Tuple[str, int]], max_items=10):
     maxv = max(v for _, v in pairs) if pairs else 1
 
     st.markdown(f"### {title}")
-    for label, value in pairs:
-        pct = 0 if maxv == 0 else int((value / maxv) * 100)
-        html = f"""
-        <div style="border:1px solid #e5e7eb;border-radius:10px;padding:10px;margin-bottom:10px;">
-          <div style="display:flex;justify-content:space-between;font-size:12px;color:#111;">
-            <div style="max-width:75%;white-space:nowrap;overflow:hidden;text-overflow:ellipsis;">{label}</div>
-            <div style="font-weight:700;">{value}</div>
-          </div>
-          <div style="background:#f3f4f6;border-radius:10px;height:10px;margin-top:8px;overflow:hidden;">
-            <div style="width:{pct}%;height:10px;background:#1f77b4;"></div>
-          </div>
-        </div>
-        """
-        st.markdown(html, unsafe_allow_html=True)
+    # todas las barras en un solo st.markdown (un elemento en vez de uno por fila)
+    html = "".join(
+        BAR_ROW_HTML.format(label=label, value=value, pct=0 if maxv == 0 else int((value / maxv) * 100))
+        for label, value in pairs
+    )
+    st.markdown(html, unsafe_allow_html=True)
 
 
 def supervisor_panel():
@@ -1045,6 +1304,8 @@ def supervisor_panel():
             try:
                 if not username or not full_name or not password:
                     st.error("Completa usuario, nombre y clave.")
+                elif not USERNAME_RE.fullmatch(username.strip()):
+                    st.error("Usuario inválido: no puede contener espacios.")
                 else:
                     create_user(username, full_name, password, role, active)
                     st.success("✅ Usuario creado correctamente")
@@ -1052,10 +1313,25 @@ def supervisor_panel():
                 st.error("Ese usuario ya existe.")
 
         st.markdown("## Lista de usuarios")
-        st.dataframe(fetch_users(), use_container_width=True)
+        # columnas y tipos explícitos: Streamlit no infiere el esquema Arrow fila por fila
+        users_df = pd.DataFrame.from_records(
+            fetch_users(), columns=["id", "username", "full_name", "role", "active", "created_at"]
+        ).astype({"active": bool})
+        st.dataframe(
+            users_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={"active": st.column_config.CheckboxColumn("active")},
+        )
 
     with tabs[1]:
         st.markdown("## Reportes pendientes (requiere firma supervisor)")
+
+        # resultados de sincronización ya mostrados (terminados) en la corrida anterior
+        sync_jobs = st.session_state.setdefault("pdf_sync_jobs", {})
+        for job_id in st.session_state.pop("pdf_sync_shown", set()):
+            sync_jobs.pop(job_id, None)
+
         pending = fetch_pending_reports()
         if not pending:
             st.info("No hay reportes pendientes.")
@@ -1078,21 +1354,21 @@ def supervisor_panel():
                 st.write(f"**Estado:** {rep['estado_general']}")
                 st.write(f"**Obs:** {rep.get('obs_general') or 'NINGUNA'}")
 
-            st.dataframe(items, use_container_width=True, hide_index=True)
+            # solo las columnas del detalle (sin id/report_id): Streamlit no infiere el esquema fila por fila
+            items_df = pd.DataFrame.from_records(
+                items, columns=["seccion", "item", "estado", "observacion", "foto_path"]
+            )
+            st.dataframe(
+                items_df,
+                use_container_width=True,
+                hide_index=True,
+                column_config={"foto_path": st.column_config.LinkColumn("foto")},
+            )
 
             st.markdown("### Supervisor (firma obligatoria)")
             supervisor_nombre = st.text_input("Nombre Supervisor", value=SUPERVISOR_NOMBRE_DEFAULT, key=f"sup_name_{rep_id}")
 
-            sig = st_canvas(
-                fill_color="rgba(255,255,255,0)",
-                stroke_width=2,
-                stroke_color="#000000",
-                background_color="#FFFFFF",
-                height=120,
-                width=520,
-                drawing_mode="freedraw",
-                key=f"sig_sup_{rep_id}"
-            )
+            sig = _signature_canvas(f"sig_sup_{rep_id}")
 
             if st.button("✅ Aprobar y generar PDF final", key=f"ap_{rep_id}"):
                 firma_path = save_signature_from_canvas(sig, "signatures", f"SUP_{rep_id}")
@@ -1103,53 +1379,56 @@ def supervisor_panel():
 
                     pdf_path = generate_checklist_pdf(rep_id)
 
-                    # Subir PDF a Drive
-                    pdf_folder_id = os.environ.get("DRIVE_PDFS_ID", "").strip()
-                    pdf_drive_url = upload_file_to_drive(pdf_path, pdf_folder_id)
-
-                    # Actualizar Sheets (si está configurado)
-                    update_report_row_in_sheet(rep_id, {
+                    # Subir PDF a Drive y actualizar Sheets sin bloquear al supervisor:
+                    # el PDF local ya está listo para descargar
+                    fut = _sync_executor().submit(_sync_approved_report, rep_id, pdf_path, {
                         "supervisor_user": st.session_state["user"],
                         "supervisor_nombre": supervisor_nombre,
                         "supervisor_firma_path": firma_path,
                         "approved_at": datetime.now().isoformat(timespec="seconds"),
                         "estado": "APROBADO",
-                        "pdf_path": pdf_drive_url,
                     })
-
-                    st.success("Aprobado. PDF generado.")
-                    if pdf_drive_url:
-                        st.markdown(f"📄 **PDF en Drive:** {pdf_drive_url}")
-
+                    # los bytes se leen una sola vez: el botón de descarga sigue disponible entre corridas
                     with open(pdf_path, "rb") as f:
-                        st.download_button("⬇️ Descargar PDF", data=f.read(),
-                                           file_name=os.path.basename(pdf_path),
-                                           mime="application/pdf")
+                        sync_jobs[rep_id] = (fut, os.path.basename(pdf_path), f.read())
+
+                    st.success("Aprobado. PDF generado (subida a Drive en curso).")
+
+        # descargas fuera del fragment: el polling de estado no vuelve a enviar los PDF
+        for job_id, (_, pdf_name, pdf_bytes) in sync_jobs.items():
+            st.download_button(f"⬇️ Descargar PDF (informe #{job_id})", data=pdf_bytes,
+                               file_name=pdf_name,
+                               mime="application/pdf",
+                               key=f"dl_pdf_{job_id}")
+        if any(not fut.done() for fut, _, _ in sync_jobs.values()):
+            _pdf_sync_status()
+        elif sync_jobs:
+            # todas terminadas: se muestran sin polling y se descartan en la próxima corrida
+            _render_pdf_sync_jobs()
+            st.session_state["pdf_sync_shown"] = set(sync_jobs)
 
     with tabs[2]:
         st.markdown("## Panel de control (Profesional)")
 
         rango = st.selectbox("Rango", ["Diario", "Semanal", "Mensual"], index=0, key="dash_rango")
         today = date.today()
-        if rango == "Diario":
-            start = today
-        elif rango == "Semanal":
-            start = today - timedelta(days=7)
-        else:
-            start = today - timedelta(days=30)
+        start = _rango_start(rango, today)
 
-        conn = db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT created_date, operador_nombre, equipment_codigo, equipment_nombre, estado_general, resultado_final
-            FROM reports
-            WHERE created_date >= ?
-        """, (start.isoformat(),))
-        rows = [dict(r) for r in c.fetchall()]
+        rows = fetch_reports_since(start.isoformat())
+
+        # una sola pasada sobre los registros para KPIs y rankings
+        res_counter, op_counts, eq_counts, falla_counts = Counter(), Counter(), Counter(), Counter()
+        for r in rows:
+            k = f"{r['equipment_nombre']} ({r['equipment_codigo']})"
+            res_counter[r["resultado_final"]] += 1
+            op_counts[r["operador_nombre"]] += 1
+            eq_counts[k] += 1
+            if r["estado_general"] in ("FALLA", "INOPERATIVO"):
+                falla_counts[k] += 1
 
         total = len(rows)
-        operadores = len(set(r["operador_nombre"] for r in rows)) if rows else 0
-        equipos_con_envio = len(set(r["equipment_codigo"] for r in rows)) if rows else 0
+        operadores = len(op_counts)
+        equipos_con_envio = len(eq_counts)
         total_equipos = len(EQUIPOS)
         equipos_sin_envio = total_equipos - equipos_con_envio
 
@@ -1159,23 +1438,9 @@ def supervisor_panel():
         k3.metric("Equipos con envíos", equipos_con_envio)
         k4.metric("Equipos sin envío", equipos_sin_envio)
 
-        op_counts = {}
-        for r in rows:
-            op_counts[r["operador_nombre"]] = op_counts.get(r["operador_nombre"], 0) + 1
-        top_op = sorted(op_counts.items(), key=lambda x: x[1], reverse=True)
-
-        eq_counts = {}
-        for r in rows:
-            k = f"{r['equipment_nombre']} ({r['equipment_codigo']})"
-            eq_counts[k] = eq_counts.get(k, 0) + 1
-        top_eq = sorted(eq_counts.items(), key=lambda x: x[1], reverse=True)
-
-        falla_counts = {}
-        for r in rows:
-            if r["estado_general"] in ("FALLA", "INOPERATIVO"):
-                k = f"{r['equipment_nombre']} ({r['equipment_codigo']})"
-                falla_counts[k] = falla_counts.get(k, 0) + 1
-        top_f = sorted(falla_counts.items(), key=lambda x: x[1], reverse=True)
+        top_op = op_counts.most_common()
+        top_eq = eq_counts.most_common()
+        top_f = falla_counts.most_common()
 
         colA, colB = st.columns(2)
         with colA:
@@ -1185,23 +1450,15 @@ def supervisor_panel():
 
         _bar_list("Fallas por Equipo (Top 10)", top_f, 10)
 
-        res_counts = {"APTO": 0, "RESTRICCIONES": 0, "NO APTO": 0}
-        for r in rows:
-            res_counts[r["resultado_final"]] = res_counts.get(r["resultado_final"], 0) + 1
         st.markdown("### Resumen Resultados")
-        st.write(f"✅ APTO: **{res_counts['APTO']}**  |  ⚠️ RESTRICCIONES: **{res_counts['RESTRICCIONES']}**  |  ⛔ NO APTO: **{res_counts['NO APTO']}**")
+        st.write(f"✅ APTO: **{res_counter['APTO']}**  |  ⚠️ RESTRICCIONES: **{res_counter['RESTRICCIONES']}**  |  ⛔ NO APTO: **{res_counter['NO APTO']}**")
 
     with tabs[3]:
         st.markdown("## Informe para Gerencia (PDF)")
         rango = st.selectbox("Tipo reporte", ["Diario", "Semanal", "Mensual"], key="ger_rango")
 
         today = date.today()
-        if rango == "Diario":
-            start = today
-        elif rango == "Semanal":
-            start = today - timedelta(days=7)
-        else:
-            start = today - timedelta(days=30)
+        start = _rango_start(rango, today)
 
         supervisor_nombre = st.text_input("Supervisor (para el PDF)", value=SUPERVISOR_NOMBRE_DEFAULT, key="ger_sup")
 
@@ -1228,10 +1485,12 @@ def _reset_operator_checklist_state():
     for k in keys:
         if (
             "::" in k
+            or k.startswith("chk_")
             or k.startswith("hor_")
             or k.startswith("sig_op_")
             or k.startswith("obsgen_")
             or k.startswith("send_")
+            or k == "fotos_subidas"
         ):
             try:
                 del st.session_state[k]
@@ -1243,8 +1502,6 @@ def operator_panel():
     st.subheader(f"👷 Operador: {st.session_state.get('full_name','')}")
     st.info("Selecciona equipo → completa checklist → firma → enviar (queda PENDIENTE hasta firma del supervisor).")
 
-    eq_label_map = {f"{e['nombre']}": e for e in EQUIPOS}
-
     def _on_equipo_change():
         _reset_operator_checklist_state()
         st.session_state["op_prev_sel"] = st.session_state.get("op_eq_select")
@@ -1252,73 +1509,79 @@ def operator_panel():
 
     sel = st.selectbox(
         "Equipo",
-        list(eq_label_map.keys()),
+        list(EQUIPOS_POR_NOMBRE.keys()),
         key="op_eq_select",
         on_change=_on_equipo_change
     )
-    eq = eq_label_map[sel]
+    eq = EQUIPOS_POR_NOMBRE[sel]
 
     horometro = st.number_input("Horómetro inicial", min_value=0, step=1, value=0, key=f"hor_{eq['codigo']}")
 
     st.markdown("## Lista de verificación")
 
+    # un solo widget (data_editor) para toda la lista en vez de selectbox + text_input por ítem
+    checklist_df = pd.DataFrame(
+        [
+            {"seccion": seccion, "item": item, "estado": STATUS_OPCIONES[0], "observacion": ""}
+            for seccion, items in CHECKLISTS[eq["tipo"]]
+            for item in items
+        ]
+    )
+    edited = st.data_editor(
+        checklist_df,
+        key=f"chk_{eq['codigo']}",
+        num_rows="fixed",
+        hide_index=True,
+        use_container_width=True,
+        disabled=["seccion", "item"],
+        column_config={
+            "seccion": st.column_config.TextColumn("Sección"),
+            "item": st.column_config.TextColumn("Ítem"),
+            "estado": st.column_config.SelectboxColumn("Estado", options=STATUS_OPCIONES, required=True),
+            "observacion": st.column_config.TextColumn("Observación (si aplica)"),
+        },
+    )
+
     items_payload = []
     estados_all = []
-
-    checklist = CHECKLISTS[eq["tipo"]]
-
-    for seccion, items in checklist:
-        st.markdown(f"### {seccion}")
-        for item in items:
-            c1, c2, c3 = st.columns([2.2, 1.2, 2.2])
-            with c1:
-                st.write(item)
-            with c2:
-                estado = st.selectbox(
-                    "Estado",
-                    STATUS_OPCIONES,
-                    key=f"{eq['codigo']}::{seccion}::{item}::estado"
-                )
-            with c3:
-                obs = st.text_input(
-                    "Observación (si aplica)",
-                    key=f"{eq['codigo']}::{seccion}::{item}::obs"
-                )
-
-            foto_path = ""
-            if estado in ("OPERATIVO CON FALLA", "INOPERATIVO"):
-                up = st.file_uploader(
-                    f"Foto obligatoria: {item}",
-                    type=["png", "jpg", "jpeg", "webp"],
-                    key=f"{eq['codigo']}::{seccion}::{item}::foto"
-                )
-                if up:
-                    foto_path = save_uploaded_image(up, "photos", f"{eq['codigo']}_{item}".replace(" ", "_")[:40])
-
-            estados_all.append(estado)
-            items_payload.append({
-                "seccion": seccion,
-                "item": item,
-                "estado": estado,
-                "observacion": obs.strip(),
-                "foto_path": foto_path
-            })
+    con_falla = []
+
+    for row in edited.to_dict("records"):
+        estado = row["estado"] or STATUS_OPCIONES[0]
+        estados_all.append(estado)
+        it = {
+            "seccion": row["seccion"],
+            "item": row["item"],
+            "estado": estado,
+            "observacion": (row["observacion"] or "").strip(),
+            "foto_path": ""
+        }
+        items_payload.append(it)
+        if estado in ("OPERATIVO CON FALLA", "INOPERATIVO"):
+            con_falla.append(it)
+
+    # los file_uploader se crean solo para los ítems con falla
+    if con_falla:
+        st.markdown("### Fotos obligatorias (ítems con falla)")
+        for it in con_falla:
+            up = st.file_uploader(
+                f"Foto obligatoria: {it['item']} ({it['seccion']})",
+                type=["png", "jpg", "jpeg", "webp"],
+                key=f"{eq['codigo']}::{it['seccion']}::{it['item']}::foto"
+            )
+            if up:
+                # cada rerun vuelve a entregar el mismo archivo: se sube a Drive una sola vez por file_id
+                fotos = st.session_state.setdefault("fotos_subidas", {})
+                if up.file_id not in fotos:
+                    fotos[up.file_id] = save_uploaded_image(up, "photos", FILE_PREFIX_INVALID_RE.sub("_", f"{eq['codigo']}_{it['item']}")[:40])
+                it["foto_path"] = fotos[up.file_id]
 
     estado_general, resultado_final = compute_result(estados_all)
 
     st.markdown("## Firma operador")
     st.write(f"Resultado automático: **{resultado_final}**")
 
-    sig = st_canvas(
-        fill_color="rgba(255,255,255,0)",
-        stroke_width=2,
-        stroke_color="#000000",
-        background_color="#FFFFFF",
-        height=120,
-        width=520,
-        drawing_mode="freedraw",
-        key=f"sig_op_{eq['codigo']}"
-    )
+    sig = _signature_canvas(f"sig_op_{eq['codigo']}")
 
     obs_general = st.text_area("Observaciones generales (opcional)", key=f"obsgen_{eq['codigo']}")
 
@@ -1357,36 +1620,40 @@ def operator_panel():
         # operador_user, operador_nombre, created_at, resultado_final, observaciones_generales,
         # operador_firma_path, supervisor_user, supervisor_nombre, supervisor_firma_path,
         # approved_at, estado, pdf_path
-        append_row_sheet("reports", [
-            report_id,
-            payload["equipment_tipo"],
-            payload["equipment_codigo"],
-            payload["equipment_nombre"],
-            payload["horometro"],
-            payload["operador_user"],
-            payload["operador_nombre"],
-            payload["created_at"],
-            payload["resultado_final"],
-            payload.get("obs_general", ""),
-            payload.get("firma_operador_path", ""),
-            "",  # supervisor_user
-            "",  # supervisor_nombre
-            "",  # supervisor_firma_path
-            "",  # approved_at
-            "PENDIENTE",  # estado
-            "",  # pdf_path
-        ])
-
         # report_items: report_id, seccion, item, estado, observacion, foto_path
-        for it in payload["items"]:
-            append_row_sheet("report_items", [
+        # ambas hojas en un solo request
+        append_rows_multi_sheet({
+            "reports": [[
                 report_id,
-                it["seccion"],
-                it["item"],
-                it["estado"],
-                it.get("observacion", ""),
-                it.get("foto_path", ""),
-            ])
+                payload["equipment_tipo"],
+                payload["equipment_codigo"],
+                payload["equipment_nombre"],
+                payload["horometro"],
+                payload["operador_user"],
+                payload["operador_nombre"],
+                payload["created_at"],
+                payload["resultado_final"],
+                payload.get("obs_general", ""),
+                payload.get("firma_operador_path", ""),
+                "",  # supervisor_user
+                "",  # supervisor_nombre
+                "",  # supervisor_firma_path
+                "",  # approved_at
+                "PENDIENTE",  # estado
+                "",  # pdf_path
+            ]],
+            "report_items": [
+                [
+                    report_id,
+                    it["seccion"],
+                    it["item"],
+                    it["estado"],
+                    it.get("observacion", ""),
+                    it.get("foto_path", ""),
+                ]
+                for it in payload["items"]
+            ],
+        })
 
         st.success(f"✅ Reporte enviado. ID: {report_id} (pendiente firma supervisor).")
 